@@ -1,6 +1,8 @@
+from __future__ import annotations
+
 import asyncio
 import argparse
-from copy import deepcopy
+import collections
 import json
 import time
 import os
@@ -11,23 +13,48 @@ import sha3
 import logging
 import coloredlogs
 
-from aiohttp import ClientSession
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
 from aiorpcx import RPCSession, JSONRPCConnection, JSONRPCAutoDetect, Request, serve_rs, handler_invocation, RPCError, TaskGroup
+from dataclasses import dataclass
 from functools import partial
 from hashlib import sha256
-from typing import Set, List, Optional
+from pathlib import Path
+from typing import Set, List, Optional, Tuple
+
+try:
+    # Optional, much faster for the large getblocktemplate responses
+    import orjson
+    def json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+    json_loads = orjson.loads
+except ImportError:
+    json_dumps = json.dumps
+    json_loads = json.loads
+
+try:
+    # Optional libuv based event loop; not available on windows
+    import uvloop
+except ImportError:
+    uvloop = None
 
 
 MEOWPOW_EPOCH_LENGTH = 7500
 hashratedict = {}
 
+# Seed hashes by epoch, extended lazily
+_SEED_CACHE: List[bytes] = [bytes(32)]
+
+# Single byte encodings, the common case for both
+_VARINT_SMALL = [i.to_bytes(1, 'little') for i in range(0xfd)]
+_OP_PUSH_SMALL = _VARINT_SMALL[:0x4c]
+
 def var_int(i: int) -> bytes:
     # https://en.bitcoin.it/wiki/Protocol_specification#Variable_length_integer
     # https://github.com/bitcoin/bitcoin/blob/efe1ee0d8d7f82150789f1f6840f139289628a2b/src/serialize.h#L247
     # "CompactSize"
     assert i >= 0, i
     if i<0xfd:
-        return i.to_bytes(1, 'little')
+        return _VARINT_SMALL[i]
     elif i<=0xffff:
         return b'\xfd'+i.to_bytes(2, 'little')
     elif i<=0xffffffff:
@@ -37,7 +64,7 @@ def var_int(i: int) -> bytes:
 
 def op_push(i: int) -> bytes:
     if i < 0x4C:
-        return i.to_bytes(1, 'little')
+        return _OP_PUSH_SMALL[i]
     elif i <= 0xff:
         return b'\x4c'+i.to_bytes(1, 'little')
     elif i <= 0xffff:
@@ -55,6 +82,10 @@ def formatDiff(target):
 def prune0x(s):
     return s[2:] if s.startswith('0x') else s
 
+def hex_byteswap(s: str) -> str:
+    # The C hex codec round trip beats pair swapping the string in python
+    return bytes.fromhex(prune0x(s))[::-1].hex()
+
 def dsha256(b):
     return sha256(sha256(b).digest()).digest()
 
@@ -69,7 +100,49 @@ def merkle_from_txids(txids: List[bytes]):
         txids = list(dsha256(l+r) for l,r in zip(*(iter(txids),)*2))
     return txids[0]
 
-class TemplateState:
+def seed_for_height(height: int) -> bytes:
+    epoch = height // MEOWPOW_EPOCH_LENGTH
+    keccak_256 = sha3.keccak_256
+    while len(_SEED_CACHE) <= epoch:
+        _SEED_CACHE.append(keccak_256(_SEED_CACHE[-1]).digest())
+    return _SEED_CACHE[epoch]
+
+class BlockJob:
+    # Shared by the live TemplateState and old job StateSnapshots,
+    # which both carry the job fields used here
+    def __repr__(self):
+        return f'Height:\t\t{self.height}\nAddress h160:\t\t{self.pub_h160}\nBits:\t\t{self.bits}\nTarget:\t\t{self.target}\nHeader Hash:\t\t{self.headerHash}\nVersion:\t\t{self.version}\nPrevious Header:\t\t{self.prevHash.hex()}\nExtra Txs:\t\t{self.externalTxs}\nSeed Hash:\t\t{self.seedHash.hex()}\nHeader:\t\t{self.header.hex()}\nCoinbase:\t\t{self.coinbase_tx.hex()}\nCoinbase txid:\t\t{self.coinbase_txid.hex()}'
+
+    def build_block(self, nonce: str, mixHash: str) -> str:
+        return self._header_hex + nonce + mixHash + var_int(len(self.externalTxs) + 1).hex() + self._coinbase_hex + self._ext_txs_joined
+
+
+@dataclass(repr=False)
+class StateSnapshot(BlockJob):
+    # The parts of a TemplateState needed to submit a block for an old job.
+    # All fields are immutable so they are shared rather than copied.
+    height: int
+    job_counter: int
+    pub_h160: Optional[bytes]
+    bits: Optional[str]
+    target: Optional[str]
+    headerHash: Optional[str]
+    version: int
+    prevHash: Optional[bytes]
+    externalTxs: Tuple[str, ...]
+    seedHash: Optional[bytes]
+    header: Optional[bytes]
+    coinbase_tx: Optional[bytes]
+    coinbase_txid: Optional[bytes]
+
+    # Hex encodings of the above, made once per job so submits
+    # do not re-encode kilobytes of static data
+    _header_hex: Optional[str]
+    _coinbase_hex: Optional[str]
+    _ext_txs_joined: Optional[str]
+
+
+class TemplateState(BlockJob):
     # These refer to the block that we are working on
     height: int = -1
 
@@ -87,48 +160,86 @@ class TemplateState:
 
     version: int = -1
     prevHash: Optional[bytes] = None
-    externalTxs: List[str] = []
+    externalTxs: List[str]
     seedHash: Optional[bytes] = None
     header: Optional[bytes] = None
     coinbase_tx: Optional[bytes] = None
     coinbase_txid: Optional[bytes] = None
 
+    _header_hex: Optional[str] = None
+    _coinbase_hex: Optional[str] = None
+    _ext_txs_joined: Optional[str] = None
+
+    _seed_hash_hex: Optional[str] = None
+    _target_params: Optional[tuple] = None
+    _notify_params: Optional[tuple] = None
+
+    # P2PKH output scripts, always 25 bytes (pushed with b'\x19')
+    _vout_to_miner: Optional[bytes] = None
+    _community_address: Optional[str] = None
+    _vout_to_community: Optional[bytes] = None
+
     current_commitment: Optional[str] = None
+    longpollid: Optional[str] = None
 
-    new_sessions: Set[RPCSession] = set()
-    all_sessions: Set[RPCSession] = set()
+    new_sessions: Set[RPCSession]
+    all_sessions: Set[RPCSession]
 
     awaiting_update = False
 
     job_counter = 0
     bits_counter = 0
 
+    def __init__(self):
+        # Per instance; class level defaults would be shared
+        self.externalTxs = []
+        self._ext_txs_joined = ''
+        # Little endian txids by their hex from the last template
+        self._txid_cache = {}
+        self.new_sessions = set()
+        self.all_sessions = set()
+
     @property
     def tag(self):
         return '\x1b[0;36mmeowcoin\x1b[0m'
 
     def __repr__(self):
-        return f'Height:\t\t{self.height}\nAddress h160:\t\t{self.pub_h160}\nBits:\t\t{self.bits}\nTarget:\t\t{self.target}\nHeader Hash:\t\t{self.headerHash}\nVersion:\t\t{self.version}\nPrevious Header:\t\t{self.prevHash.hex()}\nExtra Txs:\t\t{self.externalTxs}\nSeed Hash:\t\t{self.seedHash.hex()}\nHeader:\t\t{self.header.hex()}\nCoinbase:\t\t{self.coinbase_tx.hex()}\nCoinbase txid:\t\t{self.coinbase_txid.hex()}\nNew sessions:\t\t{self.new_sessions}\nSessions:\t\t{self.all_sessions}'
-
-    def build_block(self, nonce: str, mixHash: str) -> str:
-        return self.header.hex() + nonce + mixHash + var_int(len(self.externalTxs) + 1).hex() + self.coinbase_tx.hex() + ''.join(self.externalTxs)
-
-
-def add_old_state_to_queue(queue, state, drop_after: int):
+        return super().__repr__() + f'\nNew sessions:\t\t{self.new_sessions}\nSessions:\t\t{self.all_sessions}'
+
+    def snapshot(self) -> StateSnapshot:
+        return StateSnapshot(
+            height=self.height,
+            job_counter=self.job_counter,
+            pub_h160=self.pub_h160,
+            bits=self.bits,
+            target=self.target,
+            headerHash=self.headerHash,
+            version=self.version,
+            prevHash=self.prevHash,
+            externalTxs=tuple(self.externalTxs),
+            seedHash=self.seedHash,
+            header=self.header,
+            coinbase_tx=self.coinbase_tx,
+            coinbase_txid=self.coinbase_txid,
+            _header_hex=self._header_hex,
+            _coinbase_hex=self._coinbase_hex,
+            _ext_txs_joined=self._ext_txs_joined)
+
+
+def add_old_state_to_queue(queue: collections.OrderedDict, state: StateSnapshot, drop_after: int):
     id = hex(state.job_counter)[2:]
-    if id in queue[1]:
+    if id in queue:
         return
-    queue[0].append(id)
-    queue[1][id] = state
-    while len(queue[0]) > drop_after:
-        del queue[1][queue[0].pop(0)]
+    queue[id] = state
+    while len(queue) > drop_after:
+        queue.popitem(last=False)
 
-def lookup_old_state(queue, id: str) -> Optional[TemplateState]:
-    return queue[1].get(id, None)
+def lookup_old_state(queue: collections.OrderedDict, id: str) -> Optional[StateSnapshot]:
+    return queue.get(id, None)
 
 class StratumSession(RPCSession):
 
-    def __init__(self, state: TemplateState, old_states, testnet: bool, verbose: bool, node_url: str, transport):
+    def __init__(self, state: TemplateState, old_states, testnet: bool, verbose: bool, node_url: str, http: ClientSession, transport):
         connection = JSONRPCConnection(JSONRPCAutoDetect)
         super().__init__(transport, connection=connection)
         self._state = state
@@ -140,6 +251,7 @@ class StratumSession(RPCSession):
         self._transport     = transport
 
         self._node_url = node_url
+        self._http = http
 
 
         logging.info('Connection with client %s:%d established', self._client_addr.host.exploded, self._client_addr.port)
@@ -186,6 +298,7 @@ class StratumSession(RPCSession):
             raise RPCError(20, f'Invalid address {address}')
         if not self._state.pub_h160:
             self._state.pub_h160 = addr_decoded[1:]
+            self._state._vout_to_miner = b'\x76\xa9\x14' + self._state.pub_h160 + b'\x88\xac'
         return True
 
     async def handle_submit(self, worker: str, job_id: str, nonce_hex: str, header_hex: str, mixhash_hex: str):
@@ -205,8 +318,8 @@ class StratumSession(RPCSession):
             else:
                 self.logger.error('Miner submitted an old job that we did not have')
 
-        nonce_hex = bytes.fromhex(prune0x(nonce_hex))[::-1].hex()
-        mixhash_hex = bytes.fromhex(prune0x(mixhash_hex))[::-1].hex()
+        nonce_hex = hex_byteswap(nonce_hex)
+        mixhash_hex = hex_byteswap(mixhash_hex)
         
         block_hex = state.build_block(nonce_hex, mixhash_hex)
 
@@ -216,33 +329,32 @@ class StratumSession(RPCSession):
             'method':'submitblock',
             'params':[block_hex]
         }
-        async with ClientSession() as session:
-            async with session.post(f'{self._node_url}', data=json.dumps(data)) as resp:
-                json_resp = await resp.json()
-                
-                with open(f'./submit_history/{state.height}_{state.job_counter}.txt', 'w') as f:
-                    data = f'Response:\n{json.dumps(json_resp, indent=2)}\n\nState:\n{state.__repr__()}'
-                    f.write(data)
-
-                if json_resp.get('error', None):
-                    self.logger.error('RPC error (%d): %s',
-                                        json_resp['error']['code'],
-                                        json_resp['error']['message'])
-                
-                result = json_resp.get('result', None)
-                if self._verbose:
-                    if result == 'inconclusive':
-                        # inconclusive - valid submission but other block may be better, etc.
-                        self.logger.error('Block submission failed: %s', 'inconclusive')
-                    elif result == 'duplicate':
-                        self.logger.error('Block submission failed: %s', 'duplicate')
-                    elif result == 'duplicate-inconclusive':
-                        self.logger.error('Block submission failed: %s', 'duplicate-inconclusive')
-                    elif result == 'inconclusive-not-best-prevblk':
-                        self.logger.error('Block submission failed: %s', 'inconclusive-not-best-prevblk')
-                
-                if result not in (None, 'inconclusive', 'duplicate', 'duplicate-inconclusive', 'inconclusive-not-best-prevblk'):
-                    self.logger.error('Block submission failed: %s', json.dumps(json_resp))
+        async with self._http.post(self._node_url, json=data) as resp:
+            json_resp = json_loads(await resp.read())
+            
+            data = f'Response:\n{json.dumps(json_resp, indent=2)}\n\nState:\n{state.__repr__()}'
+            # Write from a thread so other miners are not blocked on disk io
+            await asyncio.get_running_loop().run_in_executor(None, Path(f'./submit_history/{state.height}_{state.job_counter}.txt').write_text, data)
+
+            if json_resp.get('error', None):
+                self.logger.error('RPC error (%d): %s',
+                                    json_resp['error']['code'],
+                                    json_resp['error']['message'])
+            
+            result = json_resp.get('result', None)
+            if self._verbose:
+                if result == 'inconclusive':
+                    # inconclusive - valid submission but other block may be better, etc.
+                    self.logger.error('Block submission failed: %s', 'inconclusive')
+                elif result == 'duplicate':
+                    self.logger.error('Block submission failed: %s', 'duplicate')
+                elif result == 'duplicate-inconclusive':
+                    self.logger.error('Block submission failed: %s', 'duplicate-inconclusive')
+                elif result == 'inconclusive-not-best-prevblk':
+                    self.logger.error('Block submission failed: %s', 'inconclusive-not-best-prevblk')
+            
+            if result not in (None, 'inconclusive', 'duplicate', 'duplicate-inconclusive', 'inconclusive-not-best-prevblk'):
+                self.logger.error('Block submission failed: %s', json.dumps(json_resp))
 
         # Get height from block hex
         block_height = int.from_bytes(bytes.fromhex(block_hex[(4+32+32+4+4)*2:(4+32+32+4+4+4)*2]), 'little', signed=False)
@@ -260,21 +372,20 @@ class StratumSession(RPCSession):
             'method':'getmininginfo',
             'params':[]
         }    
-        async with ClientSession() as session:    
-            async with session.post(f'{self._node_url}', data=json.dumps(data)) as resp:
-                try:
-                    json_obj = await resp.json()
-                    if json_obj.get('error', None):
-                        raise Exception(json_obj.get('error', None))
-                    
-                    blocks_int: int = json_obj['result']['blocks']
-                    difficulty_int: int = json_obj['result']['difficulty']
-                    networkhashps_int: int = json_obj['result']['networkhashps']
+        async with self._http.post(self._node_url, json=data) as resp:
+            try:
+                json_obj = json_loads(await resp.read())
+                if json_obj.get('error', None):
+                    raise Exception(json_obj.get('error', None))
                 
-                except Exception as e:
-                    self.logger.error('RPC error for mininginfo: %s', str(e))
-                    return
-        
+                blocks_int: int = json_obj['result']['blocks']
+                difficulty_int: int = json_obj['result']['difficulty']
+                networkhashps_int: int = json_obj['result']['networkhashps']
+            
+            except Exception as e:
+                self.logger.error('RPC error for mininginfo: %s', str(e))
+                return
+    
         hashrate = int(hashrate, 16)
         worker = str(self).strip('>').split()[3]
         hashratedict.update({worker: hashrate})
@@ -304,7 +415,57 @@ class StratumSession(RPCSession):
             self.logger.info('Mining software has yet to send data')
         return True
 
-async def stateUpdater(state: TemplateState, old_states, drop_after, verbose, node_url: str):
+async def send_job(session: RPCSession, target_params: tuple, notify_params: tuple):
+    # Target must reach the miner before the job it applies to
+    await session.send_notification('mining.set_target', target_params)
+    await session.send_notification('mining.notify', notify_params)
+
+async def send_job_to_sessions(state: TemplateState, sessions: List[RPCSession]):
+    results = await asyncio.gather(*(send_job(session, state._target_params, state._notify_params) for session in sessions), return_exceptions=True)
+    for session, result in zip(sessions, results):
+        if isinstance(result, BaseException):
+            state.logger.warning('Failed to send job to client %s:%d: %s',
+                                    session._client_addr.host.exploded, session._client_addr.port, repr(result))
+
+async def send_new_sessions_job(state: TemplateState):
+    if state._notify_params is None:
+        return
+    new_sessions = list(state.new_sessions)
+    state.new_sessions.clear()
+    state.all_sessions.update(new_sessions)
+    await send_job_to_sessions(state, new_sessions)
+
+async def publish_job(state: TemplateState, original_state: StateSnapshot, old_states, drop_after: int):
+    # state.header is final; hash it, queue the previous job and send the new one
+    state._header_hex = state.header.hex()
+    state.headerHash = dsha256(state.header)[::-1].hex()
+
+    state.job_counter += 1
+    add_old_state_to_queue(old_states, original_state, drop_after)
+
+    # Built once per job and shared by every session
+    state._target_params = (state.target,)
+    state._notify_params = (hex(state.job_counter)[2:], state.headerHash, state._seed_hash_hex, state.target, True, state.height, state.bits)
+
+    if SHOW_JOBS:
+        state.logger.info('New %s job diff \x1b[1m%s\x1b[0m height \x1b[1m%d\x1b[0m',
+                        state.tag, formatDiff(state.target), state.height)
+
+    await send_job_to_sessions(state, list(state.all_sessions))
+
+async def refresh_job_timestamp(state: TemplateState, old_states, drop_after: int):
+    # Nothing happens for 60s (magic number): re-issue the current template with
+    # a new time. Only the header's timestamp changes, so no rpc is needed.
+    ts = int(time.time())
+    if state.header is None or state.timestamp + 60 >= ts:
+        return
+    original_state = state.snapshot()
+    # version(4) prevHash(32) merkle(32) | time(4) | bits(4) height(4)
+    state.header = b''.join([state.header[:68], ts.to_bytes(4, 'little'), state.header[72:]])
+    state.timestamp = ts
+    await publish_job(state, original_state, old_states, drop_after)
+
+async def stateUpdater(state: TemplateState, old_states, drop_after, verbose, node_url: str, http: ClientSession):
     if not state.pub_h160:
         return
     data = {
@@ -313,185 +474,177 @@ async def stateUpdater(state: TemplateState, old_states, drop_after, verbose, no
         'method':'getblocktemplate',
         'params':[]
     }
-    async with ClientSession() as session:
-        async with session.post(f'{node_url}', data=json.dumps(data)) as resp:
-            try:
-                json_obj = await resp.json()
-                if json_obj.get('error', None):
-                    raise Exception(json_obj.get('error', None))
-
-                version_int: int = json_obj['result']['version']
-                height_int: int = json_obj['result']['height'] 
-                bits_hex: str = json_obj['result']['bits'] 
-                prev_hash_hex: str = json_obj['result']['previousblockhash']
-                txs_list: List = json_obj['result']['transactions']
-                coinbase_sats_int: int = json_obj['result']['coinbasevalue'] 
-                witness_hex: str = json_obj['result']['default_witness_commitment']
-                coinbase_flags_hex: str = json_obj['result']['coinbaseaux']['flags']
-                target_hex: str = json_obj['result']['target']
-                #target_hex: str = '000000ff00000000000000000000000000000000000000000000000000000000'
-                community_address: str = json_obj['result']['CommunityAutonomousAddress']
-                community_sats_int: int = json_obj['result']['CommunityAutonomousValue']
-
-                ts = int(time.time())
-                new_witness = witness_hex != state.current_commitment
-                state.current_commitment = witness_hex
-                state.target = target_hex
-                state.bits = bits_hex
-                state.version = version_int
-                state.prevHash = bytes.fromhex(prev_hash_hex)[::-1]
-
-                new_block = False
-
-                original_state = None
-
-                # The following will only change when there is a new block.
-                # Force update is unnecessary
-                if state.height == -1 or state.height != height_int:
-                    original_state = deepcopy(state)
-                    # New block, update everything
-                    if verbose:
-                        state.logger.info('%s New block, updating state',
-                                    state.tag)                                
-                    new_block = True
-
-                    # Generate seed hash #
-                    if state.height == - 1 or height_int > state.height:
-                        if not state.seedHash:
-                            seed_hash = bytes(32)
-                            for _ in range(height_int//MEOWPOW_EPOCH_LENGTH):
-                                k = sha3.keccak_256()
-                                k.update(seed_hash)
-                                seed_hash = k.digest()
-                            if verbose:
-                                state.logger.info('Initialized %s seedhash to \x1b[1m%s\x1b[0m',
-                                                                state.tag, seed_hash.hex())                                
-                            state.seedHash = seed_hash
-                        elif state.height % MEOWPOW_EPOCH_LENGTH == 0:
-                            # Hashing is expensive, so want use the old val
-                            k = sha3.keccak_256()
-                            k.update(state.seedHash)
-                            seed_hash = k.digest()
-                            if verbose:
-                                state.logger.info('Updated %s seedhash to \x1b[1m%s\x1b[0m',
-                                                                state.tag, seed_hash.hex())                                
-                            state.seedHash = seed_hash
-                    elif state.height > height_int:
-                        # Maybe a chain reorg?
-                        
-                        # If the difference between heights is greater than how far we are into the epoch
-                        if state.height % MEOWPOW_EPOCH_LENGTH - (state.height - height_int) < 0:
-                            # We must go back an epoch; recalc
-                            seed_hash = bytes(32)
-                            for _ in range(height_int//MEOWPOW_EPOCH_LENGTH):
-                                k = sha3.keccak_256()
-                                k.update(seed_hash)
-                                seed_hash = k.digest()
-                            if verbose:
-                                state.logger.info('Reverted %s seedhash to \x1b[1m%s\x1b[0m',
-                                                                state.tag, seed_hash.hex())                                
-                            state.seedHash = seed_hash
-
-                    # Done with seed hash #
-                    state.height = height_int
-
-                # The following occurs during both new blocks & new txs & nothing happens for 60s (magic number)
-                if new_block or new_witness or state.timestamp + 60 < ts:
-                    # Generate coinbase #
-
-                    if original_state is None:
-                        original_state = deepcopy(state)
-
-                    bytes_needed_sub_1 = 0
-                    while True:
-                        if state.height <= (2**(7 + (8 * bytes_needed_sub_1))) - 1:
-                            break
-                        bytes_needed_sub_1 += 1
-
-                    bip34_height = state.height.to_bytes(bytes_needed_sub_1 + 1, 'little')
-
-                    # Note that there is a max allowed length of arbitrary data.
-                    # I forget what it is (TODO lol) but note that this string is close
-                    # to the max.
-                    arbitrary_data = b'/meowcoin-stratum-proxy/'
-                    coinbase_script = op_push(len(bip34_height)) + bip34_height + op_push(len(arbitrary_data)) + arbitrary_data
-                    coinbase_txin = bytes(32) + b'\xff'*4 + var_int(len(coinbase_script)) + coinbase_script + b'\xff'*4
-                    vout_to_miner = b'\x76\xa9\x14' + state.pub_h160 + b'\x88\xac'
-                    vout_to_community = b'\x76\xa9\x14' + base58.b58decode_check(community_address)[1:] + b'\x88\xac'
-
-                    # Concerning the default_witness_commitment:
-                    # https://github.com/bitcoin/bips/blob/master/bip-0141.mediawiki#commitment-structure
-                    # Because the coinbase tx is '00'*32 in witness commit,
-                    # We can take what the node gives us directly without changing it
-                    # (This assumes that the txs are in the correct order, but I think
-                    # that is a safe assumption)
-
-                    witness_vout = bytes.fromhex(witness_hex)
-
-                    state.coinbase_tx = (int(1).to_bytes(4, 'little') + \
-                                    b'\x00\x01' + \
-                                    b'\x01' + coinbase_txin + \
-                                    b'\x03' + \
-                                        coinbase_sats_int.to_bytes(8, 'little') + op_push(len(vout_to_miner)) + vout_to_miner + \
-                                        community_sats_int.to_bytes(8, 'little') + op_push(len(vout_to_community)) + vout_to_community + \
-                                        bytes(8) + op_push(len(witness_vout)) + witness_vout + \
-                                    b'\x01\x20' + bytes(32) + bytes(4))
-
-                    coinbase_no_wit = int(1).to_bytes(4, 'little') + \
-                                        b'\x01' + coinbase_txin + \
-                                        b'\x03' + \
-                                            coinbase_sats_int.to_bytes(8, 'little') + op_push(len(vout_to_miner)) + vout_to_miner + \
-                                            community_sats_int.to_bytes(8, 'little') + op_push(len(vout_to_community)) + vout_to_community + \
-                                            bytes(8) + op_push(len(witness_vout)) + witness_vout + \
-                                        bytes(4)
-                    state.coinbase_txid = dsha256(coinbase_no_wit)
-
-
-                    # Create merkle & update txs
-                    txids = [state.coinbase_txid]
-                    incoming_txs = []
-                    for tx_data in txs_list:
-                        incoming_txs.append(tx_data['data'])
-                        txids.append(bytes.fromhex(tx_data['txid'])[::-1])
-                    state.externalTxs = incoming_txs
-                    merkle = merkle_from_txids(txids)
-
-                    # Done create merkle & update txs
-
-                    state.header = version_int.to_bytes(4, 'little') + \
-                            state.prevHash + \
-                            merkle + \
-                            ts.to_bytes(4, 'little') + \
-                            bytes.fromhex(bits_hex)[::-1] + \
-                            state.height.to_bytes(4, 'little')
-
-                    state.headerHash = dsha256(state.header)[::-1].hex()
-                    state.timestamp = ts
-
-                    state.job_counter += 1
-                    add_old_state_to_queue(old_states, original_state, drop_after)
-
-                    if SHOW_JOBS:
-                        state.logger.info('New %s job diff \x1b[1m%s\x1b[0m height \x1b[1m%d\x1b[0m',
-                                        state.tag, formatDiff(target_hex), state.height)                
-
-                    for session in state.all_sessions:
-                        await session.send_notification('mining.set_target', (target_hex,))
-                        await session.send_notification('mining.notify', (hex(state.job_counter)[2:], state.headerHash, state.seedHash.hex(), target_hex, True, state.height, bits_hex))
-                
-                for session in state.new_sessions:
-                    state.all_sessions.add(session)
-                    await session.send_notification('mining.set_target', (target_hex,))
-                    await session.send_notification('mining.notify', (hex(state.job_counter)[2:], state.headerHash, state.seedHash.hex(), target_hex, True, state.height, bits_hex))
-                
-                state.new_sessions.clear()
-
-            except Exception as e:
-                state.logger.critical('RPC error for getblocktemplate: %s', str(e))
-                state.logger.critical('Sleeping for 5 minutes.')
-                state.logger.critical('Any solutions found during this time may not be current.')
-                state.logger.critical('Try restarting the proxy.')
-                await asyncio.sleep(300)
+    # Once we have a template let the node hold the request until it has a new one.
+    # Never abandon a long poll: the node keeps an rpc thread on it until it answers,
+    # and abandoned polls would starve submitblock. The 60s timestamp refresh is done
+    # locally by refresh_job_timestamp instead.
+    if state.longpollid is not None:
+        data['params'] = [{'longpollid': state.longpollid}]
+        timeout = ClientTimeout(total=None)
+    else:
+        timeout = http.timeout
+    try:
+        async with http.post(node_url, json=data, timeout=timeout) as resp:
+            json_obj = json_loads(await resp.read())
+        if json_obj.get('error', None):
+            raise Exception(json_obj.get('error', None))
+
+        version_int: int = json_obj['result']['version']
+        height_int: int = json_obj['result']['height'] 
+        bits_hex: str = json_obj['result']['bits'] 
+        prev_hash_hex: str = json_obj['result']['previousblockhash']
+        txs_list: List = json_obj['result']['transactions']
+        coinbase_sats_int: int = json_obj['result']['coinbasevalue'] 
+        witness_hex: str = json_obj['result']['default_witness_commitment']
+        coinbase_flags_hex: str = json_obj['result']['coinbaseaux']['flags']
+        target_hex: str = json_obj['result']['target']
+        longpollid: Optional[str] = json_obj['result'].get('longpollid', None)
+        #target_hex: str = '000000ff00000000000000000000000000000000000000000000000000000000'
+        community_address: str = json_obj['result']['CommunityAutonomousAddress']
+        community_sats_int: int = json_obj['result']['CommunityAutonomousValue']
+
+        ts = int(time.time())
+        state.longpollid = longpollid
+        new_witness = witness_hex != state.current_commitment
+        state.current_commitment = witness_hex
+        state.target = target_hex
+        state.bits = bits_hex
+        state.version = version_int
+        state.prevHash = bytes.fromhex(prev_hash_hex)[::-1]
+
+        new_block = False
+
+        original_state = None
+
+        # The following will only change when there is a new block.
+        # Force update is unnecessary
+        if state.height == -1 or state.height != height_int:
+            original_state = state.snapshot()
+            # New block, update everything
+            if verbose:
+                state.logger.info('%s New block, updating state',
+                            state.tag)                                
+            new_block = True
+
+            # Generate seed hash #
+            seed_hash = seed_for_height(height_int)
+            if seed_hash != state.seedHash:
+                if not state.seedHash:
+                    action = 'Initialized'
+                elif state.height > height_int:
+                    # Maybe a chain reorg; we went back an epoch
+                    action = 'Reverted'
+                else:
+                    action = 'Updated'
+                if verbose:
+                    state.logger.info('%s %s seedhash to \x1b[1m%s\x1b[0m',
+                                                    action, state.tag, seed_hash.hex())
+                state.seedHash = seed_hash
+                state._seed_hash_hex = seed_hash.hex()
+
+            # Done with seed hash #
+            state.height = height_int
+
+        # The following occurs during both new blocks & new txs & nothing happens for 60s (magic number)
+        if new_block or new_witness or state.timestamp + 60 < ts:
+            # Generate coinbase #
+
+            if original_state is None:
+                original_state = state.snapshot()
+
+            bytes_needed_sub_1 = 0
+            while True:
+                if state.height <= (2**(7 + (8 * bytes_needed_sub_1))) - 1:
+                    break
+                bytes_needed_sub_1 += 1
+
+            bip34_height = state.height.to_bytes(bytes_needed_sub_1 + 1, 'little')
+
+            # Note that there is a max allowed length of arbitrary data.
+            # I forget what it is (TODO lol) but note that this string is close
+            # to the max.
+            arbitrary_data = b'/meowcoin-stratum-proxy/'
+            coinbase_script = b''.join([op_push(len(bip34_height)), bip34_height, op_push(len(arbitrary_data)), arbitrary_data])
+            coinbase_txin = b''.join([bytes(32), b'\xff'*4, var_int(len(coinbase_script)), coinbase_script, b'\xff'*4])
+            vout_to_miner = state._vout_to_miner
+            if community_address != state._community_address:
+                state._community_address = community_address
+                state._vout_to_community = b'\x76\xa9\x14' + base58.b58decode_check(community_address)[1:] + b'\x88\xac'
+            vout_to_community = state._vout_to_community
+
+            # Concerning the default_witness_commitment:
+            # https://github.com/bitcoin/bips/blob/master/bip-0141.mediawiki#commitment-structure
+            # Because the coinbase tx is '00'*32 in witness commit,
+            # We can take what the node gives us directly without changing it
+            # (This assumes that the txs are in the correct order, but I think
+            # that is a safe assumption)
+
+            witness_vout = bytes.fromhex(witness_hex)
+
+            # The outputs are the same with and without the witness
+            coinbase_vouts = b''.join([
+                b'\x03',
+                    coinbase_sats_int.to_bytes(8, 'little'), b'\x19', vout_to_miner,
+                    community_sats_int.to_bytes(8, 'little'), b'\x19', vout_to_community,
+                    bytes(8), op_push(len(witness_vout)), witness_vout])
+
+            state.coinbase_tx = b''.join([
+                int(1).to_bytes(4, 'little'),
+                b'\x00\x01',
+                b'\x01', coinbase_txin,
+                coinbase_vouts,
+                b'\x01\x20', bytes(32), bytes(4)])
+            state._coinbase_hex = state.coinbase_tx.hex()
+
+            coinbase_no_wit = b''.join([
+                int(1).to_bytes(4, 'little'),
+                b'\x01', coinbase_txin,
+                coinbase_vouts,
+                bytes(4)])
+            state.coinbase_txid = dsha256(coinbase_no_wit)
+
+
+            # Create merkle & update txs
+            txids = [state.coinbase_txid]
+            incoming_txs = []
+            # Most txs carry over between templates, so reuse their decoded txids.
+            # Only txids in this template are kept for the next one.
+            txid_cache = {}
+            for tx_data in txs_list:
+                incoming_txs.append(tx_data['data'])
+                txid_hex = tx_data['txid']
+                txid = state._txid_cache.get(txid_hex, None)
+                if txid is None:
+                    txid = bytes.fromhex(txid_hex)[::-1]
+                txid_cache[txid_hex] = txid
+                txids.append(txid)
+            state._txid_cache = txid_cache
+            if incoming_txs != state.externalTxs:
+                state.externalTxs = incoming_txs
+                state._ext_txs_joined = ''.join(incoming_txs)
+            merkle = merkle_from_txids(txids)
+
+            # Done create merkle & update txs
+
+            state.header = b''.join([
+                version_int.to_bytes(4, 'little'),
+                state.prevHash,
+                merkle,
+                ts.to_bytes(4, 'little'),
+                bytes.fromhex(bits_hex)[::-1],
+                state.height.to_bytes(4, 'little')])
+            state.timestamp = ts
+
+            await publish_job(state, original_state, old_states, drop_after)
+
+        await send_new_sessions_job(state)
+
+    except Exception as e:
+        state.logger.critical('RPC error for getblocktemplate: %s', str(e))
+        state.logger.critical('Sleeping for 5 minutes.')
+        state.logger.critical('Any solutions found during this time may not be current.')
+        state.logger.critical('Try restarting the proxy.')
+        await asyncio.sleep(300)
 
 def main():
 
@@ -546,20 +699,27 @@ def main():
     state.logger = logger
 
     # Stores old state info
-    historical_states = [list(), dict()]
+    historical_states = collections.OrderedDict()
     # only save 20 historic states (magic number)
     store = 20
 
-    session_generator = partial(StratumSession, state, historical_states, testnet, verbose, node_url)
+    async def updateState(http: ClientSession):
+        while True:
+            await stateUpdater(state, historical_states, store, verbose, node_url, http)
+            # stateUpdater long polls the node once it has a template;
+            # this only paces retries
+            await asyncio.sleep(0.1)
 
-    async def updateState():
+    async def updateSessions():
+        # A long poll holds stateUpdater until the node has a new template,
+        # so the timestamp refresh and new miners' first job are done from here
         while True:
-            await stateUpdater(state, historical_states, store, verbose, node_url)
-            # Check for new blocks / new transactions every 0.1 seconds
-            # stateUpdater should fast fail if no differences
+            await refresh_job_timestamp(state, historical_states, store)
+            await send_new_sessions_job(state)
             await asyncio.sleep(0.1)
 
-    async def beginServing():
+    async def beginServing(http: ClientSession):
+        session_generator = partial(StratumSession, state, historical_states, testnet, verbose, node_url, http)
         try:
             server = await serve_rs(session_generator, proxy_ip, proxy_port, reuse_address=True)
             logging.info('Serving on {}:{}'.format(*server.sockets[0].getsockname()))
@@ -571,9 +731,12 @@ def main():
             return
 
     async def execute():
-        async with TaskGroup(wait=any) as group:
-            await group.spawn(updateState())
-            await group.spawn(beginServing())
+        # One keep-alive connection pool to the node shared by every rpc call
+        async with ClientSession(connector=TCPConnector(limit=8, keepalive_timeout=60), json_serialize=json_dumps) as http:
+            async with TaskGroup(wait=any) as group:
+                await group.spawn(updateState(http))
+                await group.spawn(updateSessions())
+                await group.spawn(beginServing(http))
 
         for task in group.tasks:
             if not task.cancelled():
@@ -581,6 +744,8 @@ def main():
                 if exc:
                     raise exc        
 
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     asyncio.run(execute())
 
 if __name__ == "__main__":